@@ -1,21 +1,35 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait)
 import hashlib
 import os
+import queue
 import random
 import shutil
+import sqlite3
 import sys
+import threading
 import xml.etree.ElementTree as ET
-import zlib
+
+try:
+    # ISA-L's CRC32 uses carry-less multiplication where the CPU has it and
+    # is several times faster than zlib's.
+    from isal.isal_zlib import crc32
+except ImportError:
+    from zlib import crc32
 
 
 class GameFile:
-    def __init__(self, rom_node):
-        self.name = rom_node.attrib['name']
-        self.size = rom_node.attrib['size']
-        self.crc = rom_node.attrib['crc'].lower()
-        self.md5 = rom_node.attrib['md5'].lower()
-        self.sha1 = rom_node.attrib['sha1'].lower()
+    __slots__ = ('name', 'size', 'crc', 'md5', 'sha1', '__checksums')
+
+    def __init__(self, name, size, crc, md5, sha1):
+        self.name = name
+        self.size = sys.intern(size)
+        self.crc = sys.intern(crc.lower())
+        self.md5 = sys.intern(md5.lower())
+        self.sha1 = sys.intern(sha1.lower())
+        self.__checksums = (self.sha1, self.md5, self.crc, self.size)
 
     def __eq__(self, other):
         if self.name != other.name:
@@ -32,16 +46,18 @@ class GameFile:
         return hash((self.name, self.size, self.crc, self.md5, self.sha1))
 
     def checksums(self):
-        return (self.sha1, self.md5, self.crc, self.size)
+        return self.__checksums
 
 
 class Game:
-    def __init__(self, console, game_node):
-        self.console = console
-        self.name = game_node.attrib['name']
+    __slots__ = ('console', 'name', 'files')
+
+    def __init__(self, console, name, files):
+        self.console = sys.intern(console)
+        self.name = name
         file_list = []
-        for child in game_node.findall('rom'):
-            file_list.append(GameFile(child))
+        for file in files:
+            file_list.append(GameFile(*file))
         self.files = tuple(file_list)
 
     def __eq__(self, other):
@@ -55,46 +71,219 @@ class Game:
         return hash((self.console, self.name, self.files))
 
 
+CHUNK_SIZE = 1 << 20
+
+
+def fill_buffers(f, buffers, free, filled):
+    try:
+        while True:
+            index = free.get()
+            if index is None:
+                return
+            length = f.readinto(buffers[index])
+            filled.put((index, length))
+            if not length:
+                return
+    except Exception as e:
+        filled.put((None, e))
+
+
+def read_chunks(f, size):
+    if size <= CHUNK_SIZE:
+        buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(buffer)
+        while True:
+            length = f.readinto(buffer)
+            if not length:
+                return
+            yield view[:length]
+
+    # Hashing and reading both release the GIL, so a reader thread can fill
+    # one buffer while the caller is still hashing the other.
+    buffers = [bytearray(CHUNK_SIZE), bytearray(CHUNK_SIZE)]
+    views = [memoryview(b) for b in buffers]
+    free = queue.Queue()
+    filled = queue.Queue()
+    for index in range(len(buffers)):
+        free.put(index)
+    reader = threading.Thread(
+        target=fill_buffers, args=(f, buffers, free, filled), daemon=True)
+    reader.start()
+
+    try:
+        while True:
+            index, length = filled.get()
+            if index is None:
+                raise length
+            if not length:
+                return
+            yield views[index][:length]
+            free.put(index)
+    finally:
+        free.put(None)
+        reader.join()
+
+
+def read_file(file):
+    with open(file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        yield from read_chunks(f, size)
+
+
+def crc_file(file):
+    crc = 0
+    for data in read_file(file):
+        crc = crc32(data, crc)
+
+    return '{:08x}'.format(crc)
+
+
+def sha1_file(file):
+    sha1 = hashlib.sha1()
+    for data in read_file(file):
+        sha1.update(data)
+
+    return sha1.hexdigest()
+
+
+def file_id(stat):
+    # Some Windows filesystems have no file IDs and report 0.
+    if not stat.st_ino:
+        return None
+    return (stat.st_dev, stat.st_ino)
+
+
+def path_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+class HashCache:
+    # Rows are keyed by path. The size, mtime, inode and ctime are only used
+    # to check a row still describes the file there. Files this script moves
+    # have their rows moved along with them.
+    SCHEMA_VERSION = 3
+
+    def __init__(self, cache_file):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        self.__conn = sqlite3.connect(cache_file)
+        self.__used_paths = set()
+        version = self.__conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self.__conn.execute('DROP TABLE IF EXISTS hashes')
+            self.__conn.execute(
+                'PRAGMA user_version = {}'.format(self.SCHEMA_VERSION))
+        self.__conn.execute(
+            'CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, '
+            'size INTEGER, mtime INTEGER, ino TEXT, ctime INTEGER, crc TEXT, '
+            'sha1 TEXT)')
+
+    def get(self, path, stat):
+        key = path_key(path)
+        row = self.__conn.execute(
+            'SELECT crc, sha1 FROM hashes WHERE path = ? AND size = ? '
+            'AND mtime = ? AND ino = ? AND ctime = ?',
+            (key, stat.st_size, stat.st_mtime_ns, str(stat.st_ino),
+             stat.st_ctime_ns)).fetchone()
+        if row is not None:
+            self.__used_paths.add(key)
+        return row
+
+    def put(self, path, stat, crc, sha1):
+        key = path_key(path)
+        self.__used_paths.add(key)
+        self.__conn.execute(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (key, stat.st_size, stat.st_mtime_ns, str(stat.st_ino),
+             stat.st_ctime_ns, crc, sha1))
+
+    def moved(self, src, dst):
+        stat = os.stat(dst)
+        src_key = path_key(src)
+        dst_key = path_key(dst)
+        # A move keeps the size and mtime, and the row for src was checked
+        # earlier in this run.
+        cursor = self.__conn.execute(
+            'UPDATE OR REPLACE hashes SET path = ?, ino = ?, ctime = ? '
+            'WHERE path = ? AND size = ? AND mtime = ?',
+            (dst_key, str(stat.st_ino), stat.st_ctime_ns, src_key,
+             stat.st_size, stat.st_mtime_ns))
+        if cursor.rowcount:
+            self.__used_paths.discard(src_key)
+            self.__used_paths.add(dst_key)
+
+    def copied(self, src, dst):
+        stat = os.stat(src)
+        row = self.__conn.execute(
+            'SELECT crc, sha1 FROM hashes WHERE path = ? AND size = ? '
+            'AND mtime = ?',
+            (path_key(src), stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is not None:
+            self.put(dst, os.stat(dst), *row)
+
+    def prune(self, rom_dir):
+        # Drop the rows under rom_dir this run never used, e.g., for deleted
+        # files. Rows for other ROM directories are left alone.
+        prefix = os.path.join(path_key(rom_dir), '')
+        rows = self.__conn.execute(
+            'SELECT path FROM hashes WHERE substr(path, 1, ?) = ?',
+            (len(prefix), prefix))
+        stale = [row for row in rows if row[0] not in self.__used_paths]
+        self.__conn.executemany('DELETE FROM hashes WHERE path = ?', stale)
+
+    def close(self):
+        self.__conn.commit()
+        self.__conn.close()
+
+
+def parse_dat(dat_file):
+    console = None
+    games = []
+
+    context = ET.iterparse(dat_file, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event != 'end':
+            continue
+        if elem.tag == 'header':
+            console = elem.find('name').text
+        elif elem.tag == 'game':
+            files = []
+            for rom_node in elem.findall('rom'):
+                attrib = rom_node.attrib
+                files.append((
+                    attrib['name'], attrib['size'], attrib['crc'],
+                    attrib['md5'], attrib['sha1']))
+            games.append((elem.attrib['name'], files))
+            # Drop the games parsed so far so the whole tree is never held.
+            root.clear()
+
+    return console, games
+
+
 class GameList:
     def __init__(self):
-        self.games = []
-
-    def append_dat(self, dat):
-        root = dat.getroot()
-        console = root.find('header').find('name').text
-
-        for child in root.findall('game'):
-            self.games.append(Game(console, child))
-            print
-
-    def lookup_file(self, file):
-        md5 = hashlib.md5()
-        sha1 = hashlib.sha1()
-        crc = 0
-        size = 0
-
-        with open(file, 'rb') as f:
-            while True:
-                data = f.read(65536)
-                if not data:
-                    break
-                md5.update(data)
-                sha1.update(data)
-                crc = zlib.crc32(data, crc)
-                size += len(data)
-
-        hashes = (
-            sha1.hexdigest(), md5.hexdigest(), '{:08x}'.format(crc), str(size))
-
-        # Necessary because different multi-file games can share some files,
-        # e.g., Rayman (Europe) and Rayman (USA) for PSX.
-        matches = []
-        for game in self.games:
+        self.__files_by_size_crc = {}
+        self.__file_sizes = set()
+
+    def append_dat(self, console, games):
+        for name, files in games:
+            game = Game(console, name, files)
             for file in game.files:
-                if hashes == file.checksums():
-                    matches.append((file, game))
+                self.__file_sizes.add(file.size)
+                key = (file.size, file.crc)
+                if key not in self.__files_by_size_crc:
+                    self.__files_by_size_crc[key] = []
+                self.__files_by_size_crc[key].append((file, game))
+
+    def has_file_size(self, size):
+        return size in self.__file_sizes
 
-        return matches
+    def lookup_crc(self, size, crc):
+        # Can give more than one match because different multi-file games can
+        # share some files, e.g., Rayman (Europe) and Rayman (USA) for PSX.
+        return self.__files_by_size_crc.get((size, crc), [])
 
 
 class GameCollection:
@@ -102,8 +291,7 @@ class GameCollection:
         self.__collection = {}
         self.unrecognised_files = set()
 
-    def add_game_file(self, db, file):
-        matches = db.lookup_file(file)
+    def add_game_file(self, file, matches):
         if not matches:
             self.unrecognised_files.add(file)
         for game_file, game in matches:
@@ -120,9 +308,8 @@ class GameCollection:
                 complete_games.add(game)
         return complete_games
 
-    def __used_files(self):
+    def __used_files(self, full_games):
         used_files = set()
-        full_games = self.__complete_games()
         for game, files in self.__collection.items():
             if game in full_games:
                 used_files.update(f.checksums() for f in files)
@@ -145,8 +332,8 @@ class GameCollection:
         raise RuntimeError("File not in game")
 
     def renames(self):
-        used_files = self.__used_files()
         full_games = self.__complete_games()
+        used_files = self.__used_files(full_games)
         file_dsts = {}
         for game, files in self.__collection.items():
             if game in full_games:
@@ -165,6 +352,114 @@ class GameCollection:
         return file_dsts
 
 
+def scan_dir(path):
+    # Same rules as os.walk: entries whose type can't be read count as files,
+    # and symlinks to directories are not followed.
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.path)
+                    continue
+                try:
+                    is_symlink = entry.is_symlink()
+                except OSError:
+                    is_symlink = False
+                if not is_symlink:
+                    subdirs.append(entry.path)
+    except OSError:
+        pass
+    return files, subdirs
+
+
+def find_files(rom_dir):
+    # Directories are listed on a thread pool since scandir spends most of
+    # its time waiting on the filesystem.
+    files = []
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        pending = {executor.submit(scan_dir, rom_dir)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                new_files, subdirs = future.result()
+                files.extend(new_files)
+                for subdir in subdirs:
+                    pending.add(executor.submit(scan_dir, subdir))
+    return files
+
+
+def identify_roms(executor, game_list, cache, roms):
+    collection = GameCollection()
+
+    # A file whose size no DAT entry has can't match, so skip hashing it.
+    # Paths that are links to the same file are grouped to be hashed once.
+    candidates = {}
+    for rom in roms:
+        stat = os.stat(rom)
+        if not game_list.has_file_size(str(stat.st_size)):
+            collection.unrecognised_files.add(rom)
+            continue
+        key = file_id(stat) or rom
+        if key not in candidates:
+            candidates[key] = (stat, [])
+        candidates[key][1].append(rom)
+
+    crcs = {}
+    sha1s = {}
+    uncached = []
+    for key, (stat, paths) in candidates.items():
+        cached = None
+        for rom in paths:
+            cached = cache.get(rom, stat)
+            if cached is not None:
+                break
+        if cached is None:
+            uncached.append(key)
+        else:
+            crcs[key], sha1s[key] = cached
+
+    uncached_roms = [candidates[key][1][0] for key in uncached]
+    new_crcs = executor.map(crc_file, uncached_roms, chunksize=8)
+    for key, crc in zip(uncached, new_crcs):
+        crcs[key] = crc
+        stat, paths = candidates[key]
+        for rom in paths:
+            cache.put(rom, stat, crc, None)
+
+    # The size and CRC32 nearly always narrow a file down to one DAT entry,
+    # so the SHA1 is only computed for the files where they don't.
+    ambiguous = []
+    for key, (stat, paths) in candidates.items():
+        matches = game_list.lookup_crc(str(stat.st_size), crcs[key])
+        if len({game_file.sha1 for game_file, _ in matches}) > 1:
+            ambiguous.append((key, matches))
+        else:
+            for rom in paths:
+                collection.add_game_file(rom, matches)
+
+    unhashed = [key for key, _ in ambiguous if sha1s.get(key) is None]
+    unhashed_roms = [candidates[key][1][0] for key in unhashed]
+    new_sha1s = executor.map(sha1_file, unhashed_roms)
+    for key, sha1 in zip(unhashed, new_sha1s):
+        sha1s[key] = sha1
+        stat, paths = candidates[key]
+        for rom in paths:
+            cache.put(rom, stat, crcs[key], sha1)
+
+    for key, matches in ambiguous:
+        matches = [m for m in matches if m[0].sha1 == sha1s[key]]
+        for rom in candidates[key][1]:
+            collection.add_game_file(rom, matches)
+
+    return collection
+
+
 def move_with_dirs(src, dst):
     os.makedirs(os.path.dirname(dst), exist_ok=True)
     shutil.move(src, dst)
@@ -175,14 +470,18 @@ def copy_with_dirs(src, dst):
     shutil.copy2(src, dst)
 
 
-def move_unrecognised_files(rom_dir, collection):
+def move_unrecognised_files(rom_dir, collection, cache):
     unrecognised = os.path.join(rom_dir, 'Unrecognised files')
+    # Every path was built by find_files joining onto rom_dir, so files
+    # already in the unrecognised directory share this prefix exactly.
+    unrecognised_prefix = os.path.join(unrecognised, '')
     for file in collection.unrecognised_files:
         dst = os.path.relpath(file, rom_dir)
-        if os.path.realpath(file).startswith(os.path.realpath(unrecognised)):
+        if file.startswith(unrecognised_prefix):
             continue
         dst = os.path.join(unrecognised, dst)
         move_with_dirs(file, dst)
+        cache.moved(file, dst)
 
 
 def create_temp_dir(rom_dir):
@@ -196,59 +495,124 @@ def create_temp_dir(rom_dir):
             pass
 
 
-def move_into_temp(collection, temp_dir):
-    files_to_move = collection.files_in_games()
-    for path, hash in files_to_move:
-        move_with_dirs(path, os.path.join(temp_dir, hash))
+def move_into_temp(files, temp_dir, cache):
+    for path, hash in files:
+        dst = os.path.join(temp_dir, hash)
+        move_with_dirs(path, dst)
+        cache.moved(path, dst)
 
 
-def move_from_temp(rom_dir, collection, temp_dir):
-    renames = collection.renames()
+def move_from_temp(rom_dir, renames, temp_dir, cache):
     for file_hash, dsts in renames.items():
         src = os.path.join(temp_dir, file_hash)
         for dst in dsts[1:]:
-            copy_with_dirs(src, os.path.join(rom_dir, dst))
-        move_with_dirs(src, os.path.join(rom_dir, dsts[0]))
+            dst = os.path.join(rom_dir, dst)
+            copy_with_dirs(src, dst)
+            cache.copied(src, dst)
+        dst = os.path.join(rom_dir, dsts[0])
+        move_with_dirs(src, dst)
+        cache.moved(src, dst)
+
+
+def is_taken(rom_dir, path, src):
+    # A file sitting where one of the destination's directories should go
+    # blocks it as well.
+    parent = os.path.dirname(path)
+    while len(parent) > len(rom_dir):
+        if os.path.lexists(parent) and not os.path.isdir(parent):
+            return True
+        parent = os.path.dirname(parent)
+
+    if not os.path.lexists(path):
+        return False
+    try:
+        return not os.path.samefile(path, src)
+    except OSError:
+        # E.g., a broken symlink.
+        return True
+
+
+def move_game_files(rom_dir, collection, cache):
+    renames = collection.renames()
+    files = collection.files_in_games()
+    paths_by_hash = {}
+    for path, file_hash in files:
+        if file_hash not in paths_by_hash:
+            paths_by_hash[file_hash] = []
+        paths_by_hash[file_hash].append(path)
+
+    # A file with a single copy and a single destination can be moved there
+    # directly, unless something is already at that destination. The
+    # filesystem is asked rather than comparing paths, since two paths that
+    # differ only in case are the same file on many filesystems. Everything
+    # else goes through a temp directory.
+    moved_to = set()
+    temp_hashes = set()
+    for file_hash, paths in paths_by_hash.items():
+        dsts = renames.get(file_hash, [])
+        if len(paths) != 1 or len(dsts) != 1:
+            temp_hashes.add(file_hash)
+            continue
+        src = paths[0]
+        dst = os.path.join(rom_dir, dsts[0])
+        if os.path.abspath(src) == os.path.abspath(dst):
+            continue
+        if path_key(dst) in moved_to or is_taken(rom_dir, dst, src):
+            temp_hashes.add(file_hash)
+            continue
+        move_with_dirs(src, dst)
+        cache.moved(src, dst)
+        moved_to.add(path_key(dst))
+
+    if not temp_hashes:
+        return
+    temp_dir = create_temp_dir(rom_dir)
+    move_into_temp(
+        ((path, h) for path, h in files if h in temp_hashes), temp_dir,
+        cache)
+    move_from_temp(
+        rom_dir, {h: d for h, d in renames.items() if h in temp_hashes},
+        temp_dir, cache)
 
 
 def clean_empty_folders(rom_dir):
-    while True:
-        empty_dirs = []
-        for root, subdirs, files in os.walk(rom_dir):
-            if not subdirs and not files:
-                empty_dirs.append(root)
-        for dir in empty_dirs:
-            os.rmdir(dir)
-        if not empty_dirs:
-            return
+    # Walking bottom-up reaches a directory after its subdirectories, so one
+    # pass is enough if the ones already removed are remembered.
+    removed = set()
+    for root, subdirs, files in os.walk(rom_dir, topdown=False):
+        if files:
+            continue
+        if all(os.path.join(root, d) in removed for d in subdirs):
+            os.rmdir(root)
+            removed.add(root)
 
 
-def main(rom_dir, dat_dir):
+def main(rom_dir, dat_dir, cache_file):
     dats = []
     with os.scandir(dat_dir) as it:
         for entry in it:
             if not entry.name.startswith('.') and entry.is_file():
                 dats.append(entry.path)
 
-    game_list = GameList()
-    for file in dats:
-        dat = ET.parse(file)
-        game_list.append_dat(dat)
-
-    roms = []
-    for root, _, files in os.walk(rom_dir):
-        roms.extend(os.path.join(root, f) for f in files)
+    roms = find_files(rom_dir)
 
-    collection = GameCollection()
-    for rom in roms:
-        collection.add_game_file(game_list, rom)
-
-    move_unrecognised_files(rom_dir, collection)
-    temp_dir = create_temp_dir(rom_dir)
-    move_into_temp(collection, temp_dir)
-    move_from_temp(rom_dir, collection, temp_dir)
+    game_list = GameList()
+    cache = HashCache(cache_file)
+    try:
+        with ProcessPoolExecutor() as executor:
+            for console, games in executor.map(parse_dat, dats):
+                game_list.append_dat(console, games)
+            collection = identify_roms(executor, game_list, cache, roms)
+
+        move_unrecognised_files(rom_dir, collection, cache)
+        move_game_files(rom_dir, collection, cache)
+        cache.prune(rom_dir)
+    finally:
+        cache.close()
     clean_empty_folders(rom_dir)
 
 
 if __name__ == '__main__':
-    main(sys.argv[1], 'DATs')
+    cache_file = os.path.join(
+        os.path.expanduser('~'), '.cache', 'rom_renamer', 'hashes.db')
+    main(sys.argv[1], 'DATs', cache_file)